@@ -2,16 +2,25 @@
 # -*- coding: utf-8 -*-
 
 import os
-import json
 import re
-import datetime
-import io
-from dataclasses import dataclass, asdict
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
 from flask import Flask, render_template, request, jsonify
-import pdfplumber
-from collections import defaultdict
+from flask.json.provider import DefaultJSONProvider
+import orjson
+from itertools import groupby
+from functools import lru_cache
+
+class OrjsonProvider(DefaultJSONProvider):
+    # orjson serialises the response dicts natively; Flask's dump options are not needed
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Configuration
 TARGET_NAME = "Rohan"
@@ -50,110 +59,163 @@ def _col_bounds_from_weekday_headers(words):
     right_bound = centers[-1] + (centers[-1] - boundaries[-1])
     return [left_bound] + boundaries + [right_bound]
 
-def _col_index(col_bounds, x_center):
-    for i in range(5):
-        if col_bounds[i] <= x_center < col_bounds[i+1]:
-            return i
+def _make_col_index(col_bounds):
+    # Specialised to the five weekday columns, with the bounds bound as closure constants
+    b0, b1, b2, b3, b4, b5 = col_bounds
+    def col_index(x):
+        if x < b0 or x >= b5: return None
+        return 0 if x < b1 else 1 if x < b2 else 2 if x < b3 else 3 if x < b4 else 4
+    return col_index
+
+def _extract_words(page):
+    # PyMuPDF word tuples: (x0, y0, x1, y1, text, block_no, line_no, word_no)
+    return [{"text": w[4], "x0": w[0], "x1": w[2], "top": w[1], "bottom": w[3]} for w in page.get_text("words")]
+
+# Per-cell helpers bind their search method as a default argument, so lookups stay local
+def _parse_dates_row(cells, _search=DATE_RE.search):
+    matches = [_search(c or "") for c in cells]
+    if sum(1 for m in matches if m) >= 4:
+        return [m.group(1).replace("-", ".") if m else "" for m in matches]
     return None
 
-def _parse_dates_row_from_grid(grid):
-    for cells in grid:
-        matches = [DATE_RE.search(c or "") for c in cells]
-        if sum(1 for m in matches if m) >= 4:
-            return [m.group(1).replace("-", ".") if m else "" for m in matches]
-    return ["", "", "", "", ""]
+def _is_time_row(cells, _search=TIME_RE.search):
+    return sum(1 for c in cells if c and _search(c)) >= 3
+
+# The same shift strings recur across many cells, so memoise the lookups
+@lru_cache(maxsize=512)
+def _time_match(s):
+    m = TIME_RE.search(s)
+    return m.group(1) if m else None
 
-def _is_time_row(cells):
-    return sum(1 for c in cells if TIME_RE.search(c or "")) >= 3
+@lru_cache(maxsize=512)
+def to_minutes(tstr):
+    h, m = map(int, tstr.split(":"))
+    return h * 60 + m
 
 # CHANGED: Function now gets the full time range string
 def _get_time_ranges(cells):
-    out = []
-    for c in cells:
-        m = TIME_RE.search(c or "")
-        out.append(m.group(1) if m else None)
-    return out
+    return [_time_match(c) if c else None for c in cells]
 
-def parse_timesheet_pdf(pdf_file, target_name=TARGET_NAME):
+def parse_timesheet_pdf(pdf_data, target_name=TARGET_NAME):
+    import pymupdf  # heavyweight; deferred until the first parse
     try:
-        with pdfplumber.open(pdf_file) as pdf:
-            if not pdf.pages: return None
-            page = pdf.pages[0]
-            text = page.extract_text() or ""
-            if target_name.lower() not in text.lower(): return None
-            week_ending = WEEK_ENDING_RE.search(text).group(1) if WEEK_ENDING_RE.search(text) else None
+        with pymupdf.open(stream=pdf_data, filetype="pdf") as pdf:
+            if pdf.page_count == 0: return None
+            page = pdf[0]
+            words = _extract_words(page)
+            # Page text rebuilt from the words, saving a second extraction pass
+            text = " ".join(w["text"] for w in words)
+            # Bail out before any grid work when the target never appears on the page
+            target_lower = target_name.lower()
+            if target_lower not in text.lower(): return None
+            m = WEEK_ENDING_RE.search(text)
+            week_ending = m.group(1) if m else None
             
-            words = page.extract_words(use_text_flow=True, keep_blank_chars=False)
             col_bounds = _col_bounds_from_weekday_headers(words)
             if not col_bounds: return None
             
-            rows = defaultdict(list)
-            for w in words:
-                if w["text"] in WEEKDAYS: continue
-                y_key = round(w["top"])
-                rows[y_key].append(w)
+            body_words = [w for w in words if w["text"] not in WEEKDAYS]
+            body_words.sort(key=lambda w: (round(w["top"]), w["x0"]))
             
-            row_keys, grid, areas = sorted(rows.keys()), [], []
-            for y in row_keys:
-                cells, area_text = [""] * 5, ""
-                for w in sorted(rows[y], key=lambda w: w['x0']):
-                    x_center = (w["x0"] + w["x1"]) / 2
-                    ci = _col_index(col_bounds, x_center)
-                    if ci is not None:
-                        cells[ci] = (cells[ci] + " " + w["text"]).strip()
-                    elif x_center < col_bounds[0]:
-                        area_text = (area_text + " " + w["text"]).strip()
-                grid.append(cells)
-                areas.append(area_text)
-            
-            header_dates = _parse_dates_row_from_grid(grid)
-            
-            last_time_ranges, current_area = None, ""
+            col_index, left_bound = _make_col_index(col_bounds), col_bounds[0]
+            header_dates, last_time_ranges, current_area = None, None, ""
             captures = {d: [] for d in WEEKDAYS}
             notes = {d: [] for d in WEEKDAYS}
             areas_by_day = {d: [] for d in WEEKDAYS}
-            for row_idx, cells in enumerate(grid):
-                if areas[row_idx]: current_area = areas[row_idx]
+            # Single pass: build each row's cells and classify it straight away
+            for _, row_words in groupby(body_words, key=lambda w: round(w["top"])):
+                buckets, area_words = [[] for _ in range(5)], []
+                for w in row_words:
+                    x_center = (w["x0"] + w["x1"]) * 0.5
+                    ci = col_index(x_center)
+                    if ci is not None:
+                        buckets[ci].append(w["text"])
+                    elif x_center < left_bound:
+                        area_words.append(w["text"])
+                cells, area_text = [" ".join(b) for b in buckets], " ".join(area_words)
+                
+                if area_text: current_area = area_text
+                if header_dates is None: header_dates = _parse_dates_row(cells)
                 if _is_time_row(cells):
                     last_time_ranges = _get_time_ranges(cells)
                     continue
                 if last_time_ranges:
                     for day_idx, day_name in enumerate(WEEKDAYS):
-                        cell_text = (cells[day_idx] or "").strip()
-                        if cell_text and target_name.lower() in cell_text.lower():
+                        cell_text = cells[day_idx]
+                        if not cell_text: continue
+                        if target_lower in cell_text.lower():
                             if last_time_ranges[day_idx]:
                                 captures[day_name].append(last_time_ranges[day_idx])
                                 areas_by_day[day_name].append(current_area)
                             if "ATM" in cell_text.upper(): notes[day_name].append("ATM")
-            
-            def to_minutes(tstr):
-                h, m = map(int, tstr.split(":"))
-                return h * 60 + m
+            if header_dates is None: header_dates = ["", "", "", "", ""]
             
             days = {}
             for i, day in enumerate(WEEKDAYS):
                 start_time, end_time, chosen_area = None, None, None
                 if captures[day]:
-                    indexed_ranges = list(zip(captures[day], areas_by_day[day]))
-                    latest_entry = sorted(indexed_ranges, key=lambda t: to_minutes(t[0].split('-')[0].strip()))[-1]
-                    chosen_range, chosen_area = latest_entry
+                    # Index breaks start-time ties in favour of the last capture, as the old sort did
+                    candidates = [(to_minutes(r.split('-')[0].strip()), idx, r, a)
+                                  for idx, (r, a) in enumerate(zip(captures[day], areas_by_day[day]))]
+                    _, _, chosen_range, chosen_area = max(candidates)
                     # CHANGED: Split the range into start and end times
                     start_time, end_time = [t.strip() for t in chosen_range.replace(" ", "").split('-')]
                 
-                note = ", ".join(sorted(list(set(notes[day])))) if notes[day] else None
-                days[day] = asdict(DayInfo(
-                    start=start_time,
-                    end=end_time, # CHANGED: Save the end time
-                    note=note,
-                    date=header_dates[i] if i < len(header_dates) else None,
-                    area=chosen_area
-                ))
+                note = ", ".join(dict.fromkeys(notes[day])) if notes[day] else None
+                # Same shape as DayInfo, built directly to skip asdict's field walk and deepcopy
+                days[day] = {
+                    "start": start_time,
+                    "end": end_time, # CHANGED: Save the end time
+                    "note": note,
+                    "date": header_dates[i] if i < len(header_dates) else None,
+                    "area": chosen_area,
+                }
             
             return WeekRecord(week_ending=week_ending, dates=header_dates, days=days)
     except Exception as e:
         print(f"Error parsing PDF: {e}")
         return None
 
+# Optional process pool for parsing, enabled by setting PARSE_WORKERS. It only helps when one
+# process serves concurrent requests (threaded server, gunicorn gthread workers); gunicorn's
+# default sync workers handle one request at a time, so there it would just add an IPC copy.
+PARSE_WORKERS = max(int(os.environ.get("PARSE_WORKERS", 0)), 0)
+_executor = None
+_executor_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(PARSE_WORKERS or 1)
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # forkserver: workers never fork from a live, threaded request process
+            ctx = multiprocessing.get_context("forkserver")
+            _executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=ctx)
+        return _executor
+
+def _discard_executor(broken):
+    global _executor
+    with _executor_lock:
+        if _executor is broken: _executor = None
+    broken.shutdown(wait=False)
+
+def _parse_in_pool(data):
+    # Parse in-process when the pool is disabled or every worker is busy
+    if not PARSE_WORKERS or not _pool_slots.acquire(blocking=False):
+        return parse_timesheet_pdf(data)
+    try:
+        executor = _get_executor()
+        try:
+            return executor.submit(parse_timesheet_pdf, data).result()
+        except BrokenProcessPool as e:
+            # A worker died (e.g. MuPDF crashed); replace the pool but never retry this
+            # upload in the web process, since it is the likely cause of the crash
+            _discard_executor(executor)
+            print(f"Error parsing PDF: {e}")
+            return None
+    finally:
+        _pool_slots.release()
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -164,9 +226,13 @@ def parse_pdf():
     file = request.files['pdf']
     if not file or not file.filename.lower().endswith('.pdf'): return jsonify({'error': 'Invalid file provided'}), 400
     try:
-        result = parse_timesheet_pdf(io.BytesIO(file.read()))
+        # The upload is read once into bytes and handed to PyMuPDF as-is; a pooled
+        # BytesIO would only add a copy in and out and keep a buffer alive per thread
+        stream = file.stream
+        if stream.seekable(): stream.seek(0)
+        result = _parse_in_pool(stream.read())
         if result is None: return jsonify({'error': f'Could not parse timesheet or {TARGET_NAME} not found'}), 400
-        response_data = asdict(result)
+        response_data = {'week_ending': result.week_ending, 'dates': result.dates, 'days': result.days}
         response_data['success'] = True
         return jsonify(response_data)
     except Exception as e: